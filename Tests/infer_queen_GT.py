@@ -1,7 +1,6 @@
-import pandas as pd
 import argparse
 from tqdm import tqdm
-from collections import defaultdict
+from collections import Counter, defaultdict
 
 # Argument Parser
 parser = argparse.ArgumentParser(description='Infers queen genotype using the genotype of drone sons.')
@@ -14,21 +13,19 @@ parser.add_argument('--haploid', action='store_true', help='Use this flag if the
 args = parser.parse_args()
 
 # ---------------------- PARSE INPUT FILES ---------------------------------
-# Read header lines including the Sample line
+# Read header lines including the Sample line, without loading the VCF body
 with open(args.vcf, 'r') as vcf_file:
-    lines = vcf_file.readlines()
+    header_lines = [next(vcf_file) for _ in range(args.rownum + 1)]
+    sample_line = next(vcf_file)
 
-header_lines = lines[:args.rownum + 1]
-column_line = header_lines[-1].strip().lstrip('#')
-column_names = column_line.split('\t')
+# The row after the header rows names the VCF columns
+vcf_columns = sample_line.rstrip('\n').split('\t')
 
-if len(column_names) != len(set(column_names)):
-    duplicates = [x for x in column_names if column_names.count(x) > 1]
+column_counts = Counter(vcf_columns)
+duplicates = [x for x, c in column_counts.items() if c > 1]
+if duplicates:
     print(f"Warning: Duplicate column names found in VCF header: {set(duplicates)}")
 
-# Read VCF data
-vcf = pd.read_csv(args.vcf, sep='\t', skiprows=args.rownum + 1, dtype=str)
-
 # Read haploid individual list
 droneID = []
 queenID = []
@@ -42,7 +39,7 @@ with open(args.list, 'r') as file:
             print('Oops: Something is wrong with the list file.')
 
 # Check samples in VCF match the list
-vcf_samples = list(vcf.columns[9:])
+vcf_samples = vcf_columns[9:]
 
 print("From list:", droneID)
 print("From VCF :", vcf_samples)
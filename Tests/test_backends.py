@@ -0,0 +1,176 @@
+"""
+Queen calls from Untitled-1.py must not depend on which optional backend is installed.
+
+Every combination of genotype parser (Python tables or Cython kernel) and counting kernel
+(numba or bit-packed NumPy) is run on the Tests/ VCFs in haploid and diploid mode and checked
+against a straight port of the original per-variant rule. The written VCF is checked against
+the original output rules: last record kept per (CHROM, POS, ID, REF, ALT), sorted by CHROM
+then POS.
+"""
+
+import gzip
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+
+import numpy as np
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Keep numba's on-disk cache for the module imported under a test name away from the script's own
+os.environ.setdefault('NUMBA_CACHE_DIR', tempfile.mkdtemp())
+spec = importlib.util.spec_from_file_location('queen_gt', os.path.join(HERE, '..', 'Untitled-1.py'))
+queen_gt = sys.modules['queen_gt'] = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(queen_gt)
+
+THRESHOLD = 0.125
+MIN_DRONES = 2
+GT_CODES = {'0/0': 0, '0/1': 1, '1/1': 2, './.': 3}
+
+
+def reference_records(vcf_path, queen_map, haploid):
+    # Original string-based rule, one variant and one queen at a time: (fixed columns, queen calls) per record
+    missing = ['.', ''] if haploid else ['./.', '']
+    ref = '0' if haploid else '0/0'
+    with queen_gt.open_maybe_gz(vcf_path) as f:
+        for line in f:
+            if line.startswith('#CHROM'):
+                samples = line.strip().split('\t')[9:]
+            if line.startswith('#'):
+                continue
+            parts = line.strip().split('\t')
+            sample_data = dict(zip(samples, parts[9:]))
+            row = []
+            for drones in queen_map.values():
+                gts = [sample_data.get(d, './.') for d in drones]
+                gts = [gt.split(':')[0] if gt != '.' else './.' for gt in gts]
+                valid = [gt for gt in gts if gt not in missing]
+                if len(valid) < MIN_DRONES:
+                    row.append('./.')
+                    continue
+                ratio = sum(gt != ref for gt in valid) / len(valid)
+                row.append('0/0' if ratio < THRESHOLD else '1/1' if ratio > 1 - THRESHOLD else '0/1')
+            yield parts[:9], row
+
+
+def reference_calls(vcf_path, queen_map, haploid):
+    calls = [[GT_CODES[gt] for gt in row] for _, row in reference_records(vcf_path, queen_map, haploid)]
+    return np.array(calls, dtype=np.int8)
+
+
+def reference_vcf(vcf_path, queen_map, haploid):
+    # Original output: '##' lines, the #CHROM line with queen names, then the last record per
+    # (CHROM, POS, ID, REF, ALT) key in a stable sort on (CHROM, int(POS))
+    records = {}
+    for fixed, row in reference_records(vcf_path, queen_map, haploid):
+        records['\t'.join(fixed[:5])] = '\t'.join(fixed + row) + '\n'
+    with queen_gt.open_maybe_gz(vcf_path) as f:
+        header = [line for line in f if line.startswith('#')]
+    header[-1] = '\t'.join(header[-1].strip().split('\t')[:9] + list(queen_map)) + '\n'
+    order = sorted(records, key=lambda key: (key.split('\t')[0], int(key.split('\t')[1])))
+    return ''.join(header) + ''.join(records[key] for key in order)
+
+
+def diploid_copy(src, dst):
+    # Recode the haploid drones as diploid calls, sprinkling in phased, missing and bare '.' fields
+    rng = random.Random(1)
+    forms = {'0': ['0/0', '0|0'], '1': ['1/1', '0/1', '1|0'], '.': ['./.', '.|.', '.']}
+    with queen_gt.open_maybe_gz(src) as f, open(dst, 'w') as out:
+        for line in f:
+            if line.startswith('#'):
+                out.write(line)
+                continue
+            parts = line.rstrip('\n').split('\t')
+            for i in range(9, len(parts)):
+                gt, sep, rest = parts[i].partition(':')
+                if rng.random() < 0.05:
+                    parts[i] = '.'
+                else:
+                    parts[i] = rng.choice(forms.get(gt, [gt])) + sep + rest
+            out.write('\t'.join(parts) + '\n')
+
+
+def family_map(fam_file):
+    with open(os.path.join(HERE, fam_file)) as f:
+        drones = [line.strip() for line in f if line.strip()]
+    return {'all': drones, 'first': drones[:len(drones) // 2], 'second': drones[len(drones) // 2:],
+            'absent': ['no_such_drone'] + drones[:1]}
+
+
+@pytest.fixture(params=['F35', 'F43', 'F35_diploid'])
+def dataset(request, tmp_path):
+    if request.param == 'F35_diploid':
+        vcf = str(tmp_path / 'F35_diploid.vcf')
+        diploid_copy(os.path.join(HERE, 'F35_renamed.vcf.gz'), vcf)
+        return vcf, family_map('F35_fam.txt')
+    return os.path.join(HERE, request.param + '_renamed.vcf.gz'), family_map(request.param + '_fam.txt')
+
+
+@pytest.mark.parametrize('haploid', [True, False], ids=['hap', 'dip'])
+@pytest.mark.parametrize('parser', ['python', 'cython'])
+@pytest.mark.parametrize('counter', ['numba', 'numpy'])
+@pytest.mark.parametrize('threads', [1, 2])
+def test_backends_match_reference(dataset, haploid, parser, counter, threads, monkeypatch):
+    if parser == 'cython' and queen_gt.pyximport is None:
+        pytest.skip('Cython not installed')
+    if counter == 'numba' and queen_gt.njit is None:
+        pytest.skip('numba not installed')
+    if parser == 'python':
+        monkeypatch.setattr(queen_gt, 'infer_kernel', None)
+    if counter == 'numpy':
+        monkeypatch.setattr(queen_gt, 'njit', None)
+    monkeypatch.setattr(queen_gt, 'PARALLEL_MIN_CELLS', 0)  # the test VCFs are far below it
+
+    vcf, queen_map = dataset
+    meta_lines, vcf_cols, body_offset = queen_gt.read_vcf_header(vcf)
+    fixed, queen_gts = queen_gt.get_queen_genotypes(vcf, vcf_cols, body_offset, queen_map, THRESHOLD,
+                                                    MIN_DRONES, haploid, threads)
+
+    np.testing.assert_array_equal(queen_gts, reference_calls(vcf, queen_map, haploid))
+
+
+def unsorted_vcf(path):
+    # Out of order across chromosomes that sort differently as text and as numbers, repeated
+    # (CHROM, POS, ID, REF, ALT) keys with different QUAL and INFO, a second allele at a repeated
+    # position, a record missing sample columns, CRLF line endings
+    samples = ['d1', 'd2', 'd3', 'd4']
+    body = [('chr2', 500, 'A', 'G', ['0', '1', '1', '1']),
+            ('chr10', 20, 'C', 'T', ['0', '0', '0', '1']),
+            ('chr1', 300, 'G', 'A', ['1', '1', '.', '1']),
+            ('chr2', 40, 'T', 'C', ['0', '1']),
+            ('chr1', 300, 'G', 'C', ['0', '0', '0', '0']),
+            ('chr10', 20, 'C', 'T', ['1', '1', '1', '0']),
+            ('chr1', 7, 'A', 'T', ['.', '0', '1', '0']),
+            ('chr2', 500, 'A', 'G', ['0', '0', '0', '0'])]
+    lines = ['##fileformat=VCFv4.2', '##contig=<ID=chr1>', '##contig=<ID=chr2>', '##contig=<ID=chr10>',
+             '\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + samples)]
+    for i, (chrom, pos, ref, alt, gts) in enumerate(body):
+        lines.append('\t'.join([chrom, str(pos), '.', ref, alt, str(10 * i), 'PASS', f'N={i}', 'GT:DP']
+                               + [gt + ':5' for gt in gts]))
+    with open(path, 'w', newline='') as out:
+        out.write('\r\n'.join(lines) + '\r\n')
+
+
+@pytest.mark.parametrize('haploid', [True, False], ids=['hap', 'dip'])
+@pytest.mark.parametrize('parser', ['python', 'cython'])
+def test_combined_vcf_matches_original_output(tmp_path, haploid, parser, monkeypatch):
+    if parser == 'cython' and queen_gt.pyximport is None:
+        pytest.skip('Cython not installed')
+    if parser == 'python':
+        monkeypatch.setattr(queen_gt, 'infer_kernel', None)
+
+    vcf = str(tmp_path / 'unsorted.vcf')
+    unsorted_vcf(vcf)
+    queen_map = {'qa': ['d1', 'd2', 'd3'], 'qb': ['d2', 'd3', 'd4', 'no_such_drone']}
+    output = str(tmp_path / 'all_queens.vcf.gz')
+
+    meta_lines, vcf_cols, body_offset = queen_gt.read_vcf_header(vcf)
+    fixed, queen_gts = queen_gt.get_queen_genotypes(vcf, vcf_cols, body_offset, queen_map, THRESHOLD,
+                                                    MIN_DRONES, haploid)
+    queen_gt.write_combined_vcf(output, meta_lines, vcf_cols, list(queen_map), fixed, queen_gts)
+
+    with gzip.open(output, 'rt', newline='') as f:
+        assert f.read() == reference_vcf(vcf, queen_map, haploid)
+    assert os.path.exists(output + '.tbi')
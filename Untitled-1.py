@@ -18,7 +18,7 @@ Results:
 
 import argparse
 import gzip
-import subprocess
+import numpy as np
 import pandas as pd
 import pysam
 from collections import defaultdict
@@ -26,6 +26,40 @@ from tqdm import tqdm
 import os
 import sys
 from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+try:
+    from isal import igzip  # ISA-L gzip, several times faster than zlib for decompression
+except ImportError:
+    igzip = None
+
+try:
+    import pyximport  # builds the Cython genotype tokenizer (infer_kernel.pyx) on first import
+except ImportError:
+    pyximport = None
+
+infer_kernel = None
+if pyximport is not None:
+    # The kernel sits next to this script, wherever it is run or imported from
+    kernel_dir = os.path.dirname(os.path.abspath(__file__))
+    if not os.path.exists(os.path.join(kernel_dir, 'infer_kernel.pyx')):
+        print(f"Warning: infer_kernel.pyx not found in {kernel_dir}, using the Python genotype parser", file=sys.stderr)
+    else:
+        # Hook the import machinery only for this one module
+        pyx_hooks = pyximport.install(language_level=3)
+        sys.path.insert(0, kernel_dir)
+        try:
+            import infer_kernel
+        except ImportError as e:
+            print(f"Warning: could not build infer_kernel.pyx, using the Python genotype parser ({e})", file=sys.stderr)
+        finally:
+            sys.path.remove(kernel_dir)
+            pyximport.uninstall(*pyx_hooks)
+
+try:
+    from numba import njit  # JIT for the genotype counting kernel
+except ImportError:
+    njit = None
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Build queen's genotype based on drones' genotypes.")
@@ -34,7 +68,9 @@ def parse_args():
     parser.add_argument('--list',
                     type=str, required=True, help='Address of the input list of queens and drones.')
     parser.add_argument('--threads',
-                    type=int, default=1, help='Number of threads to use (default: 1)')
+                    type=int, default=1, help='Worker processes for counting drone genotypes, used only for inputs with at least '
+                                               f'{PARALLEL_MIN_CELLS:,} variant x drone genotypes; the VCF is always parsed '
+                                               'in a single process (default: 1)')
     parser.add_argument('--out',
                     type=str, required=True, help='Address of the output folder.')
     parser.add_argument('--min_drones', 
@@ -47,10 +83,27 @@ def parse_args():
     return parser.parse_args()
 
 def open_maybe_gz(filename, mode='rt'):
+    encoding = None if 'b' in mode else 'utf-8'
     if filename.endswith('.gz'):
-        return gzip.open(filename, mode=mode, encoding='utf-8')
+        if igzip is not None:
+            return igzip.open(filename, mode=mode, encoding=encoding)
+        return gzip.open(filename, mode=mode, encoding=encoding)
     else:
-        return open(filename, mode=mode, encoding='utf-8')
+        return open(filename, mode=mode, encoding=encoding)
+
+READ_CHUNK_SIZE = 10 * 1024 * 1024  # bytes decompressed per read
+
+def iter_lines(f, chunk_size=READ_CHUNK_SIZE):
+    # Split large binary chunks on newlines instead of a small decompress per readline()
+    carry = b''
+    while True:
+        buf = f.read(chunk_size)
+        if not buf:
+            break
+        *lines, carry = (carry + buf).split(b'\n')
+        yield from lines
+    if carry:
+        yield carry
 
 def extract_vital_header_lines(vcf_file):
     vital_headers = []
@@ -64,105 +117,239 @@ def extract_vital_header_lines(vcf_file):
                 break  # Stop reading after the header is complete
     return vital_headers
 
-def get_queen_genotypes(input_vcf, queen_name, drones, threshold, min_drones, haploid=False):
-    genotypes = {}  # variant_key -> queen_gt
-    info_map = {}   # variant_key -> info_cols
-
-    with open_maybe_gz(input_vcf) as f:
-        header_line = None
+def read_vcf_header(vcf_file):
+    # Meta lines, #CHROM columns and the uncompressed byte offset of the first record, in one scan
+    meta_lines = []
+    offset = 0
+    with open_maybe_gz(vcf_file, 'rb') as f:
         for line in f:
-            if line.startswith('#CHROM'):
-                header_line = line.strip()
-                break
-
-        if not header_line:
-            raise ValueError("No #CHROM line found in VCF")
-
-        cols = header_line.lstrip('#').split('\t')
-        sample_names = cols[9:]
-
-        for line in f:
-            if line.startswith('#'):
-                continue
-            parts = line.strip().split('\t')
-            info_cols = parts[:9]
-            sample_data = dict(zip(sample_names, parts[9:]))
-            variant_key = '\t'.join(parts[:5])  # CHROM, POS, ID, REF, ALT
-
-            drone_gts = []
-            for d in drones:
-                gt = sample_data.get(d, './.')
-                gt = gt.split(':')[0] if gt != '.' else './.'
-                drone_gts.append(gt)
-
-            queen_gt = infer_queen_gt_from_list(drone_gts, threshold, min_drones, haploid=haploid)
-            genotypes[variant_key] = queen_gt
-            info_map[variant_key] = info_cols
-
-    return queen_name, genotypes, info_map
-
-def infer_queen_gt_from_list(drone_gts, threshold, min_drones, haploid=False):
-    # Filter valid drone genotypes (ignore missing)
-    if haploid:
-        valid_gts = [gt for gt in drone_gts if gt not in ['.', '',]]
-    else:
-        valid_gts = [gt for gt in drone_gts if gt not in ['./.', '',]]
-    total = len(valid_gts)
-    if total < min_drones:
-        return './.'  # Not enough data
-
-    # Count how many have alternate allele (anything other than '0')
-    if haploid:
-        alt_count = sum(1 for gt in valid_gts if gt != '0')
+            offset += len(line)
+            if line.startswith(b'#CHROM'):
+                return meta_lines, line.decode('utf-8').strip().split('\t'), offset
+            if line.startswith(b'##'):
+                meta_lines.append(line.decode('utf-8').rstrip('\r\n') + '\n')
+    raise ValueError("No #CHROM line found in VCF")
+
+def get_queen_genotypes(input_vcf, vcf_cols, body_offset, queen_map, threshold, min_drones, haploid=False, threads=1):
+    # Single pass over the VCF for every queen's drones at once
+    drones = list(dict.fromkeys(d for queen_drones in queen_map.values() for d in queen_drones))
+    fixed, gts = read_drone_codes(input_vcf, vcf_cols, body_offset, drones, haploid=haploid)
+
+    # Column of each queen's drones in the genotype matrix, which has one column per drone
+    col_index = {d: i for i, d in enumerate(drones)}
+    queen_cols = [np.array([col_index[d] for d in queen_drones], dtype=np.intp)
+                  for queen_drones in queen_map.values()]
+
+    if threads > 1 and gts.shape[0] > 1 and gts.size >= PARALLEL_MIN_CELLS:
+        queen_gts = infer_queen_gts_shared(gts, queen_cols, threshold, min_drones, threads)
     else:
-        alt_count = sum(1 for gt in valid_gts if gt != '0/0')
-
-    ratio = alt_count / total
+        queen_gts = np.empty((gts.shape[0], len(queen_cols)), dtype=np.int8)
+        infer_rows(gts, queen_gts, 0, gts.shape[0], tqdm(queen_cols, desc="Inferring queen genotypes"),
+                   threshold, min_drones)
+
+    return fixed, queen_gts
+
+# Genotype cells (variants x drones) below which worker start-up costs more than the counting it splits
+PARALLEL_MIN_CELLS = 200_000_000
+
+def infer_rows(gts, queen_gts, start, stop, queen_cols, threshold, min_drones):
+    # Queen calls for variants [start, stop), one column of queen_gts per queen
+    block = gts[start:stop]
+    for j, drone_idx in enumerate(queen_cols):
+        queen_gts[start:stop, j] = infer_queen_gts(np.ascontiguousarray(block[:, drone_idx]), threshold, min_drones)
+
+def infer_chunk(gts_name, gts_shape, out_name, out_shape, start, stop, queen_cols, threshold, min_drones):
+    gts_shm = shared_memory.SharedMemory(name=gts_name)
+    out_shm = shared_memory.SharedMemory(name=out_name)
+    try:
+        gts = np.ndarray(gts_shape, dtype=np.int8, buffer=gts_shm.buf)
+        queen_gts = np.ndarray(out_shape, dtype=np.int8, buffer=out_shm.buf)
+        infer_rows(gts, queen_gts, start, stop, queen_cols, threshold, min_drones)
+        del gts, queen_gts  # release the buffers before closing
+    finally:
+        gts_shm.close()
+        out_shm.close()
+
+def infer_queen_gts_shared(gts, queen_cols, threshold, min_drones, threads):
+    # Split the variants into row slabs, one worker process per slab. The genotype matrix and
+    # the queen calls live in shared memory so neither is pickled to or from the workers
+    gts_shape = gts.shape
+    out_shape = (gts_shape[0], len(queen_cols))
+    gts_shm = shared_memory.SharedMemory(create=True, size=max(gts.nbytes, 1))
+    out_shm = shared_memory.SharedMemory(create=True, size=max(out_shape[0] * out_shape[1], 1))
+    try:
+        np.ndarray(gts_shape, dtype=np.int8, buffer=gts_shm.buf)[:] = gts
+
+        chunks = np.array_split(np.arange(gts_shape[0]), threads)
+        with ProcessPoolExecutor(max_workers=threads) as executor:
+            futures = [executor.submit(infer_chunk, gts_shm.name, gts_shape, out_shm.name, out_shape,
+                                       chunk[0], chunk[-1] + 1, queen_cols, threshold, min_drones)
+                       for chunk in chunks if len(chunk)]
+            for future in tqdm(futures, desc="Inferring queen genotypes"):
+                future.result()
+
+        queen_gts = np.ndarray(out_shape, dtype=np.int8, buffer=out_shm.buf).copy()
+    finally:
+        gts_shm.close()
+        gts_shm.unlink()
+        out_shm.close()
+        out_shm.unlink()
+
+    return queen_gts
+
+def grow_capacity(buf, axis):
+    # Double the variant capacity of a buffer that is filled in place along axis
+    return np.concatenate([buf, np.empty_like(buf)], axis=axis)
+
+def read_drone_codes(input_vcf, cols, body_offset, drones, haploid=False):
+    # Both filled in place and grown by doubling: a (9, n_variants) object array, one row per fixed
+    # VCF column (CHROM, POS, ID, REF, ALT, QUAL, FILTER, INFO, FORMAT), and the dense
+    # (n_variants, n_drones) int8 genotype matrix
+    fixed = np.empty((9, 1024), dtype=object)
+    codes = np.empty((1024, len(drones)), dtype=np.int8)
+    n_variants = 0
+
+    with open_maybe_gz(input_vcf, 'rb') as f:
+        f.seek(body_offset)  # header already parsed by read_vcf_header
+        lines = iter_lines(f)
+        name_to_col = {name: i for i, name in enumerate(cols) if i >= 9}
+        # Column of each drone in a split line. Drones absent from the VCF, like sample columns
+        # missing from a record, point past the end of the line and are read as a bare '.'
+        drone_cols = [name_to_col.get(d, len(cols)) for d in drones]
+        n_drones = len(drone_cols)
+        padding = [b'.'] * (len(cols) + 1)
+        gt_codes, alt_code = (HAPLOID_GT_CODES, 2) if haploid else (DIPLOID_GT_CODES, 1)
+        # For the Cython tokenizer: position in the code row of each sample column, -1 if not a drone
+        slot = np.full(len(cols) - 9, -1, dtype=np.int32)
+        for k, col in enumerate(drone_cols):
+            if col < len(cols):
+                slot[col - 9] = k
+
+        for line in lines:
+            if not line or line.startswith(b'#'):
+                continue
+            if n_variants == fixed.shape[1]:
+                fixed = grow_capacity(fixed, axis=1)
+                codes = grow_capacity(codes, axis=0)
+            if infer_kernel is not None:
+                # Only the fixed columns are split in Python, the sample columns are scanned in C
+                parts = line.rstrip(b'\r').split(b'\t', 9)
+                fixed[:, n_variants] = [p.decode('utf-8') for p in parts[:9]]
+                infer_kernel.parse_genotypes(parts[9] if len(parts) > 9 else b'', slot, codes[n_variants], haploid)
+                n_variants += 1
+                continue
 
-    # Infer queen diploid genotype based on ratio
-    if ratio < threshold:
-        return '0/0'    # Mostly reference
-    elif ratio > (1 - threshold):
-        return '1/1'    # Mostly alternate
+            # Only the fixed columns are decoded, genotypes stay bytes
+            parts = line.rstrip(b'\r').split(b'\t')
+            fixed[:, n_variants] = [p.decode('utf-8') for p in parts[:9]]
+            parts += padding[len(parts):]
+
+            # A bare '.' sample field is read as './.'
+            codes[n_variants] = np.fromiter((gt_codes.get(b'./.' if parts[i] == b'.' else parts[i].partition(b':')[0], alt_code)
+                                             for i in drone_cols), dtype=np.int8, count=n_drones)
+            n_variants += 1
+
+    return fixed[:, :n_variants], codes[:n_variants]
+
+# Genotype string -> int8 code: 0=0/0, 1=0/1, 2=1/1, 3=missing.
+# Haploid calls are missing if '.' or empty and alternate unless '0'; diploid calls are missing
+# if './.' or empty and alternate unless '0/0'. Anything not listed gets the default alt code
+HAPLOID_GT_CODES = {b'0': 0, b'1': 2, b'.': 3, b'': 3}
+DIPLOID_GT_CODES = {b'0/0': 0, b'0/1': 1, b'1/1': 2, b'./.': 3, b'': 3}
+
+# Queen calls are int8 codes until they are written out
+GT_STRINGS = np.array(['0/0', '0/1', '1/1', './.'], dtype=object)
+
+def count_gt_states(gts):
+    # Drones per variant in each state (0=0/0, 1=0/1, 2=1/1, 3=missing), all four in one pass
+    n_variants, n_drones = gts.shape
+    counts = np.zeros((n_variants, 4), dtype=np.int32)
+    for v in range(n_variants):
+        c0 = c1 = c2 = c3 = 0
+        for d in range(n_drones):
+            gt = gts[v, d]
+            if gt == 0:
+                c0 += 1
+            elif gt == 1:
+                c1 += 1
+            elif gt == 2:
+                c2 += 1
+            else:
+                c3 += 1
+        counts[v, 0] = c0
+        counts[v, 1] = c1
+        counts[v, 2] = c2
+        counts[v, 3] = c3
+    return counts
+
+if njit is not None:
+    count_gt_states = njit(nogil=True, cache=True)(count_gt_states)
+
+def infer_queen_gts(gts, threshold, min_drones):
+    if njit is not None:
+        counts = count_gt_states(gts)
+        total = counts[:, 0] + counts[:, 1] + counts[:, 2]
+        alt_count = counts[:, 1] + counts[:, 2]
     else:
-        return '0/1'    # Mixed alleles (heterozygous)
-
-def extract_samples_from_header(vcf_file):
-    with open_maybe_gz(vcf_file) as f:
-        for line in f:
-            if line.startswith('#CHROM'):
-                header_cols = line.lstrip('#').strip().split('\t')
-                # Samples start from the 10th column (index 9)
-                return header_cols[9:]
-    return []
-
-def variant_key_sorter(key):
-    chrom, pos, *_ = key.split('\t')
-    pos = int(pos)
-    return (chrom, pos)
-
-def write_combined_vcf(output_path, input_vcf, queen_names, all_genotypes, info_map):
-    temp_vcf = output_path.rstrip('.gz')
-    variant_keys = sorted(all_genotypes.keys(), key=variant_key_sorter)
-
-    with open(temp_vcf, 'w') as out:
+        # Without numba: bit-pack the called/alt masks and popcount them
+        n_words = (gts.shape[1] + 63) // 64
+        valid_bits = pack_words(gts != 3, n_words)
+        alt_bits = pack_words((gts == 1) | (gts == 2), n_words)
+        total = popcount_rows(valid_bits)
+        alt_count = popcount_rows(alt_bits & valid_bits)
+    return infer_queen_gts_from_counts(alt_count, total, threshold, min_drones)
+
+def pack_words(mask, n_words):
+    # Pack a (n_variants, n_drones) mask into a (n_variants, n_words) uint64 bitmap, 64 drones per word
+    bitmap = np.zeros((mask.shape[0], n_words * 8), dtype=np.uint8)
+    packed = np.packbits(mask, axis=1, bitorder='little')
+    bitmap[:, :packed.shape[1]] = packed
+    return bitmap.view(np.uint64)
+
+def popcount_rows(bitmap):
+    # Number of set bits per variant
+    if hasattr(np, 'bitwise_count'):  # NumPy >= 2.0
+        return np.bitwise_count(bitmap).sum(axis=1, dtype=np.int64)
+    return np.unpackbits(bitmap.view(np.uint8), axis=1).sum(axis=1, dtype=np.int64)
+
+def infer_queen_gts_from_counts(alt_count, total, threshold, min_drones):
+    ratio = alt_count / np.maximum(total, 1)
+
+    # Infer queen diploid genotype based on ratio:
+    # not enough data, mostly reference, mostly alternate, otherwise mixed alleles (heterozygous)
+    return np.select([total < min_drones, ratio < threshold, ratio > (1 - threshold)],
+                     [3, 0, 2], default=1).astype(np.int8)
+
+def variant_order(fixed):
+    # Row of the last record for each (CHROM, POS, ID, REF, ALT), ordered by (CHROM, POS) with a
+    # NumPy lexsort on category codes and integer positions
+    last_row = {variant_key: i for i, variant_key in enumerate(zip(*fixed[:5]))}
+    rows = np.fromiter(last_row.values(), dtype=np.intp, count=len(last_row))
+    chrom_codes = pd.Categorical(fixed[0, rows]).codes
+    positions = fixed[1, rows].astype(np.int64)
+    return rows[np.lexsort((positions, chrom_codes))]
+
+def format_rows(rows):
+    # Whole VCF body in one '%' format over the (n_variants, n_cols) matrix instead of a join per line
+    n_rows, n_cols = rows.shape
+    template = ('\t'.join(['%s'] * n_cols) + '\n') * n_rows
+    return template % tuple(rows.ravel())
+
+def write_combined_vcf(output_path, meta_lines, vcf_cols, queen_names, fixed, queen_gts):
+    order = variant_order(fixed)
+
+    rows = np.empty((len(order), 9 + len(queen_names)), dtype=object)
+    rows[:, :9] = fixed[:, order].T
+    rows[:, 9:] = GT_STRINGS[queen_gts[order]]  # back to genotype strings only here
+
+    # bgzip in-process, no temporary plain-text VCF
+    with pysam.BGZFile(output_path, 'wb') as out:
         # Write headers
-        with open_maybe_gz(input_vcf) as f:
-            for line in f:
-                if line.startswith('##'):
-                    out.write(line)
-                elif line.startswith('#CHROM'):
-                    fixed_cols = line.strip().split('\t')[:9]
-                    out.write('\t'.join(fixed_cols + queen_names) + '\n')
-                    break
-
-        for variant_key in variant_keys:
-            info_cols = info_map[variant_key]
-            queen_gts = [all_genotypes[variant_key].get(q, './.') for q in queen_names]
-            out.write('\t'.join(info_cols + queen_gts) + '\n')
-
-    subprocess.run(['bgzip', '-f', temp_vcf], check=True)
-    subprocess.run(['tabix', '-p', 'vcf', output_path], check=True)
+        header = meta_lines + ['\t'.join(vcf_cols[:9] + queen_names) + '\n']
+        out.write(''.join(header).encode('utf-8'))
+        out.write(format_rows(rows).encode('utf-8'))
+
+    pysam.tabix_index(output_path, preset='vcf', force=True)
 
 def main():
     if '--version' in sys.argv:
@@ -184,7 +371,9 @@ def main():
             else:
                 print(f"Bad line in list file: {line.strip()}")
 
-    vcf_samples = extract_samples_from_header(args.vcf)
+    meta_lines, vcf_cols, body_offset = read_vcf_header(args.vcf)
+    # Samples start from the 10th column (index 9)
+    vcf_samples = set(vcf_cols[9:])
 
     for queen, drones in queen_map.items():
         missing = [d for d in drones if d not in vcf_samples]
@@ -193,22 +382,11 @@ def main():
 
     os.makedirs(args.out, exist_ok=True)
 
-    all_genotypes = defaultdict(dict)  # variant_key -> {queen1: gt1, ...}
-    shared_info_map = {}
-
-    with ProcessPoolExecutor(max_workers=args.threads) as executor:
-        futures = []
-        for queen, drones in queen_map.items():
-            futures.append(executor.submit(get_queen_genotypes, args.vcf, queen, drones, args.het_thres, args.min_drones, args.haploid))
-
-        for future in tqdm(futures, desc="Processing queens"):
-            queen_name, queen_gts, info_map = future.result()
-            for variant_key, gt in queen_gts.items():
-                all_genotypes[variant_key][queen_name] = gt
-                shared_info_map[variant_key] = info_map[variant_key]
+    fixed, queen_gts = get_queen_genotypes(args.vcf, vcf_cols, body_offset, queen_map, args.het_thres,
+                                           args.min_drones, args.haploid, args.threads)
 
     output_vcf_path = os.path.join(args.out, "all_queens.vcf.gz")
-    write_combined_vcf(output_vcf_path, args.vcf, list(queen_map.keys()), all_genotypes, shared_info_map)
+    write_combined_vcf(output_vcf_path, meta_lines, vcf_cols, list(queen_map.keys()), fixed, queen_gts)
 
 if __name__ == "__main__":
     main()
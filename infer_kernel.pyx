@@ -0,0 +1,72 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+C-level genotype tokenizer for the plain-text VCF reader in Untitled-1.py.
+
+Built at runtime with pyximport when Cython and a C compiler are available; the reader
+falls back to its pure Python lookup otherwise. Codes match the reader's tables:
+0=0/0, 1=0/1, 2=1/1, 3=missing.
+"""
+
+cdef enum:
+    TAB = 9
+    COLON = 58
+    DOT = 46
+    SLASH = 47
+    ZERO = 48
+    ONE = 49
+
+cdef inline signed char gt_code(const unsigned char* s, Py_ssize_t n, bint haploid) noexcept nogil:
+    if n == 0:
+        return 3
+    if haploid:
+        if n == 1:
+            if s[0] == ZERO:
+                return 0
+            if s[0] == DOT:
+                return 3
+        return 2    # any other haploid call is alternate, './.' included
+
+    if n == 3 and s[1] == SLASH:
+        if s[0] == DOT and s[2] == DOT:
+            return 3
+        if s[0] == ZERO and s[2] == ZERO:
+            return 0
+        if s[0] == ONE and s[2] == ONE:
+            return 2
+    return 1        # any other diploid call is alternate, '.' and phased calls included
+
+def parse_genotypes(const unsigned char[::1] samples, const int[::1] slot, signed char[::1] codes, bint haploid):
+    """
+    Fill codes from the tab-separated sample columns of one VCF record.
+
+    slot[k] is the position in codes of the k-th sample column, or -1 for samples that are
+    not drones of interest. A bare '.' field, or a drone without a column in the record,
+    is read as './.'.
+    """
+    cdef Py_ssize_t n = samples.shape[0]
+    cdef Py_ssize_t n_cols = slot.shape[0]
+    cdef Py_ssize_t i = 0, col = 0, start, end, k
+    cdef const unsigned char* buf
+    cdef signed char no_field = gt_code(b'./.', 3, haploid)
+
+    for k in range(codes.shape[0]):
+        codes[k] = no_field
+    if n == 0:
+        return
+
+    with nogil:
+        buf = &samples[0]
+        while col < n_cols and i <= n:
+            start = i
+            while i < n and buf[i] != TAB:
+                i += 1
+            if slot[col] >= 0:
+                end = start
+                while end < i and buf[end] != COLON:
+                    end += 1
+                if end - start == 1 and end == i and buf[start] == DOT:
+                    codes[slot[col]] = no_field
+                else:
+                    codes[slot[col]] = gt_code(buf + start, end - start, haploid)
+            col += 1
+            i += 1
@@ -1,7 +1,10 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pac
 import argparse
 from tqdm import tqdm
-from collections import defaultdict
+from collections import Counter, defaultdict
 import gzip
 
 # Argument Parser
@@ -27,20 +30,35 @@ def open_maybe_gz(filename, mode='rt'):
         return open(filename, mode=mode, encoding='utf-8')
 
 
-# Read header lines including the Sample line
+# Read header lines including the Sample line, without loading the VCF body
 with open_maybe_gz(args.vcf) as vcf_file:
-    lines = vcf_file.readlines()
+    header_lines = [next(vcf_file) for _ in range(args.rownum + 1)]
+    sample_line = next(vcf_file)
 
-header_lines = lines[:args.rownum + 1]
-column_line = header_lines[-1].strip().lstrip('#')
-column_names = column_line.split('\t')
+# The row after the header rows names the VCF columns
+vcf_columns = sample_line.rstrip('\n').split('\t')
 
-if len(column_names) != len(set(column_names)):
-    duplicates = [x for x in column_names if column_names.count(x) > 1]
+column_counts = Counter(vcf_columns)
+duplicates = [x for x, c in column_counts.items() if c > 1]
+if duplicates:
     print(f"Warning: Duplicate column names found in VCF header: {set(duplicates)}")
 
-# Read VCF data and infers compression from filename extension
-vcf = pd.read_csv(args.vcf, sep='\t', skiprows=args.rownum + 1, dtype=str, compression='infer')
+def dedup_names(names):
+    # Rename repeated column names to 'x', 'x.1', 'x.2', ... as pandas.read_csv does,
+    # so Arrow can select every column by name
+    names = list(names)
+    counts = defaultdict(int)
+    for i, col in enumerate(names):
+        cur_count = counts[col]
+        while cur_count > 0:
+            counts[col] = cur_count + 1
+            col = f"{col}.{cur_count}"
+            cur_count = counts[col]
+        names[i] = col
+        counts[col] = cur_count + 1
+    return names
+
+vcf_columns = dedup_names(vcf_columns)
 
 # make haploid individual and queens list
 droneID = []
@@ -55,7 +73,7 @@ with open(args.list, 'r') as file:
             print('Oops: Something is wrong with the list file. LIST should have 2 columns but have 1 for some samples')
 
 # Check samples in VCF match the list
-vcf_samples = list(vcf.columns[9:])
+vcf_samples = vcf_columns[9:]
 
 print("From list:", droneID)
 print("From VCF :", vcf_samples)
@@ -69,56 +87,66 @@ else:
 #Open issues: 
 # fix the missingness hard filter
 
-def infer_queen_genotypes(vcf, droneID, queenID, header_lines, threshold):
-    family_map = defaultdict(list)
-    for drone, queen in zip(droneID, queenID):
-        family_map[queen].append(drone)
+# Genotypes counted as missing, built once rather than per queen and block
+MISSING_GTS = np.array(['./.', '.', ''])
 
-    queen_genotypes = pd.DataFrame()
-    queen_genotypes[vcf.columns[:9]] = vcf.iloc[:, :9]
+def infer_queen_genotypes(vcf, family_map, threshold):
+    queen_cols = {}
 
-    for queen, drones in tqdm(family_map.items(), desc="Inferring queen genotypes"):
+    for queen, drones in family_map.items():
         # Check again drones in VCF columns
         for d in drones:
-            if d not in vcf.columns:
+            if d not in vcf.column_names:
                 raise ValueError(f"Drone '{d}' not found in VCF columns.")
 
-        gt_list = []
+        # Genotype field only, for all variants x drones at once
+        drone_cols = np.column_stack([vcf.column(d).to_numpy(zero_copy_only=False) for d in drones]).astype(str)
+        drone_gts = np.char.partition(drone_cols, ':')[:, :, 0]
+        # Missingness subfilter
+        valid = ~np.isin(drone_gts, MISSING_GTS)
+        alt = valid & ((np.char.find(drone_gts, '1') >= 0) | (np.char.find(drone_gts, '2') >= 0))
 
-        for _, row in vcf.iterrows():
-            drone_gts = [str(row[d]).split(':')[0] for d in drones]
-            # Missingness subfilter
-            valid_gts = [gt for gt in drone_gts if gt not in ['./.', '.', '']]
+        total = valid.sum(axis=1)
+        alt_count = alt.sum(axis=1)
+        ratio = np.where(total > 0, alt_count / np.maximum(total, 1), 0)
 
-            total = len(valid_gts)
-            alt_count = sum(1 for gt in valid_gts if any(allele in gt for allele in ['1', '2']))
+        gt_list = np.select([total <= 3, ratio < threshold, ratio > (1 - threshold)],
+                            ['./.', '0/0', '1/1'], default='0/1')
 
-            if total <= 3:
-                queen_gt = './.'  
-            else:
-                ratio = alt_count / total
-                if ratio < threshold:
-                    queen_gt = '0/0'
-                elif ratio > (1 - threshold):
-                    queen_gt = '1/1'
-                else:
-                    queen_gt = '0/1'
+        queen_cols[queen] = gt_list
 
-            gt_list.append(queen_gt)
-
-        queen_genotypes[queen] = gt_list
-
-    return queen_genotypes, header_lines
+    # Build the frame once instead of inserting one column per queen
+    queen_genotypes = pd.concat([vcf.select(vcf.column_names[:9]).to_pandas().reset_index(drop=True),
+                                 pd.DataFrame(queen_cols)], axis=1)
+    return queen_genotypes
 
 # ----------------- OUTPUT --------------------------------------------------
 
-queen_vcf, headers = infer_queen_genotypes(vcf, droneID, queenID, header_lines, args.heterozygot_thres)
+def format_rows(rows):
+    # Whole VCF body in one '%' format over the (n_variants, n_cols) matrix instead of a join per line
+    n_rows, n_cols = rows.shape
+    template = ('\t'.join(['%s'] * n_cols) + '\n') * n_rows
+    return template % tuple(rows.ravel())
+
+family_map = defaultdict(list)
+for drone, queen in zip(droneID, queenID):
+    family_map[queen].append(drone)
 
 # Reconstruct the #CHROM header line with queen sample names
-new_sample_header = '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t' + '\t'.join(queen_vcf.columns[9:]) + '\n'
-headers[-1] = new_sample_header  # Replace the old sample header line
+new_sample_header = '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t' + '\t'.join(family_map.keys()) + '\n'
+header_lines[-1] = new_sample_header  # Replace the old sample header line
+
+# Stream the VCF body with the multithreaded Arrow CSV reader, all columns kept as strings,
+# and write each block of variants as soon as it is inferred. Compression is inferred from the filename extension
+vcf_reader = pac.open_csv(args.vcf,
+                          read_options=pac.ReadOptions(skip_rows=args.rownum + 2, column_names=vcf_columns,
+                                                       use_threads=True, block_size=16 * 1024 * 1024),
+                          parse_options=pac.ParseOptions(delimiter='\t', quote_char=False),
+                          convert_options=pac.ConvertOptions(column_types={c: pa.string() for c in vcf_columns}))
 
 output_vcf = args.vcf.replace('.vcf', '_queens.vcf').replace('.vcf.gz', 'GT_inferred.vcf')
 with open(output_vcf, 'w') as out_vcf:
-    out_vcf.writelines(headers)
-    queen_vcf.to_csv(out_vcf, sep='\t', index=False, header=False)
+    out_vcf.writelines(header_lines)
+    for vcf in tqdm(vcf_reader, desc="Inferring queen genotypes", unit="block"):
+        queen_vcf = infer_queen_genotypes(vcf, family_map, args.heterozygot_thres)
+        out_vcf.write(format_rows(queen_vcf.fillna('').to_numpy(dtype=object)))